@@ -1,9 +1,14 @@
-import tomli
 import os
 import platformdirs
 import argparse
 import getpass
 import sys
+from functools import cache
+
+if sys.version_info >= (3, 11):
+    import tomllib
+else:
+    import tomli as tomllib
 
 default_folder = platformdirs.user_config_dir("letterboxd_stats", getpass.getuser())
 
@@ -21,7 +26,7 @@ def load_config(file_path, defaults):
     # Load the TOML file if it exists
     if os.path.exists(file_path):
         with open(file_path, "rb") as f:
-            user_config = tomli.load(f)
+            user_config = tomllib.load(f)
     else:
         user_config = {}
 
@@ -70,6 +75,11 @@ def apply_env_variables(config):
         
     return config
 
+@cache
+def get_data_folder():
+    """Folder of the exported .csv files and of the cache, resolved once for all the modules."""
+    return os.path.expanduser(os.path.join(config["root_folder"], "static"))
+
 parser = argparse.ArgumentParser(
     prog="Letterboxd Stats",
     description="CLI tool to display Letterboxd statistics",
@@ -95,8 +105,11 @@ parser.add_argument("-c", "--config_folder", help="Specify the folder of your co
 
 args = parser.parse_args()
 
-folder = args.config_folder or default_folder
-config_path = os.path.abspath(os.path.join(folder, "config.toml"))
+# platformdirs already returns an absolute path, only a folder given by the user may be relative.
+if args.config_folder is None:
+    config_path = os.path.join(default_folder, "config.toml")
+else:
+    config_path = os.path.abspath(os.path.join(args.config_folder, "config.toml"))
 if not os.path.exists(config_path):
     raise FileNotFoundError(
         f"Found no configuration file in {config_path}. "
@@ -0,0 +1,3 @@
+from letterboxd_stats.main import main
+
+main()
@@ -0,0 +1,177 @@
+import atexit
+import os
+import sqlite3
+import threading
+import time
+from letterboxd_stats import get_data_folder
+
+# Entries older than this (in seconds) are ignored and fetched again from the web.
+EXPIRE_AFTER = 30 * 24 * 60 * 60
+# Settings that are not stored in the database file, so they must be applied to every connection.
+CONNECTION_PRAGMAS = """
+PRAGMA synchronous=NORMAL;
+PRAGMA temp_store=MEMORY;
+PRAGMA mmap_size=268435456;
+PRAGMA busy_timeout=30000;
+PRAGMA cache_size=-20000;
+"""
+# The statements are always the same strings, so they are prepared once and then found in
+# the statement cache of the connection.
+# value has no declared type, so TMDB ids (int) and Letterboxd ids (str) are stored as they are.
+# Rows are stored in the primary key B-tree itself (WITHOUT ROWID), so lookups need a single search.
+SQL_CREATE = (
+    "CREATE TABLE IF NOT EXISTS cache ("
+    "prefix TEXT NOT NULL, key TEXT NOT NULL, value, timestamp INTEGER NOT NULL, "
+    "PRIMARY KEY (prefix, key)) WITHOUT ROWID"
+)
+SQL_GET = "SELECT value FROM cache WHERE prefix = ? AND key = ? AND timestamp > ?"
+SQL_SAVE = "INSERT OR REPLACE INTO cache (prefix, key, value, timestamp) VALUES (?, ?, ?, ?)"
+SQL_PURGE = "DELETE FROM cache WHERE timestamp <= ?"
+SQL_GET_MANY = "SELECT key, value FROM cache WHERE prefix = ? AND timestamp > ? AND key IN ({})"
+# Stay below the limit of variables in a single SQLite statement.
+MAX_VARIABLES = 500
+
+_shared_cache = None
+_shared_cache_lock = threading.Lock()
+
+
+class Cache:
+    """Key-value store backed by SQLite, so that scraped ids survive between runs.
+
+    Keys are grouped by prefix: for Letterboxd links this is everything before the last "/",
+    mirroring the structure of the links found in the exported .csv files.
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        # Values already read or written during this run, to skip the query when they are needed again.
+        self._memory = {}
+        # A run lasts minutes at most while entries last EXPIRE_AFTER: the clock is read only once,
+        # and every entry saved during the run gets the same timestamp.
+        self._now = int(time.time())
+        if db_path != ":memory:":
+            os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self._closed = False
+        self._connect()
+        self._initialize_db()
+        atexit.register(self.close)
+
+    def _open_connection(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None)
+        conn.executescript(CONNECTION_PRAGMAS)
+        return conn
+
+    def _connect(self):
+        """Open the connections used for the whole run. They may be used by the threads of the scraper,
+        hence the locks. Reads and writes use different connections with different locks: in WAL mode
+        readers don't wait for writers, so ids can be looked up while others are being saved."""
+
+        self._writer = self._open_connection()
+        self._write_lock = threading.Lock()
+        # An in-memory database is private to its connection, so it can't be split.
+        if self.db_path == ":memory:":
+            self._reader, self._read_lock = self._writer, self._write_lock
+        else:
+            self._reader = self._open_connection()
+            self._reader.execute("PRAGMA query_only=1")
+            self._read_lock = threading.Lock()
+
+    def _reconnect_after_fork(self):
+        """SQLite connections must not be used across a fork (e.g. by pandarallel workers).
+        The inherited connections belong to the parent: keep them untouched and open new ones."""
+
+        if self._closed:
+            return
+        self._parent_connections = (self._writer, self._reader)
+        self._connect()
+
+    def _initialize_db(self):
+        # WAL mode is persistent, so it only needs to be set once per database file.
+        # In-memory databases don't support it.
+        if self.db_path != ":memory:":
+            self._writer.execute("PRAGMA journal_mode=WAL")
+        self._writer.execute(SQL_CREATE)
+        self.purge_expired()
+
+    def get(self, prefix: str, key: str):
+        if (prefix, key) in self._memory:
+            return self._memory[prefix, key]
+        with self._read_lock:
+            row = self._reader.execute(SQL_GET, (prefix, key, self._now - EXPIRE_AFTER)).fetchone()
+        if row is None:
+            return None
+        self._memory[prefix, key] = row[0]
+        return row[0]
+
+    def save(self, prefix: str, key: str, value):
+        with self._write_lock:
+            self._writer.execute(SQL_SAVE, (prefix, key, value, self._now))
+        self._memory[prefix, key] = value
+
+    def get_many(self, prefix: str, keys: list[str]) -> dict:
+        """Get the values of all the keys found in the cache, with one query every MAX_VARIABLES keys."""
+
+        values = {key: self._memory[prefix, key] for key in keys if (prefix, key) in self._memory}
+        keys = [key for key in keys if key not in values]
+        with self._read_lock:
+            for i in range(0, len(keys), MAX_VARIABLES):
+                chunk = keys[i : i + MAX_VARIABLES]
+                query = SQL_GET_MANY.format(",".join("?" * len(chunk)))
+                for key, value in self._reader.execute(query, (prefix, self._now - EXPIRE_AFTER, *chunk)):
+                    values[key] = self._memory[prefix, key] = value
+        return values
+
+    def save_many(self, prefix: str, items):
+        """Save many (key, value) pairs in a single transaction."""
+
+        items = dict(items)
+        with self._write_lock:
+            self._writer.execute("BEGIN")
+            try:
+                self._writer.executemany(SQL_SAVE, [(prefix, key, value, self._now) for key, value in items.items()])
+            except BaseException:
+                self._writer.execute("ROLLBACK")
+                raise
+            self._writer.execute("COMMIT")
+        self._memory.update(((prefix, key), value) for key, value in items.items())
+
+    def purge_expired(self):
+        """Lookups already skip expired entries. Delete them all at once, so they don't pile up."""
+
+        with self._write_lock:
+            self._writer.execute(SQL_PURGE, (self._now - EXPIRE_AFTER,))
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        atexit.unregister(self.close)
+        # Let SQLite refresh the statistics of the query planner, if it needs to.
+        self._writer.execute("PRAGMA optimize")
+        self._writer.close()
+        self._reader.close()
+
+
+def get_cache() -> Cache:
+    """The cache shared by the scraper and the TMDB client, stored in the data folder.
+    It is opened the first time it is needed, so importing a module doesn't touch the disk."""
+
+    global _shared_cache
+    with _shared_cache_lock:
+        if _shared_cache is None:
+            _shared_cache = Cache(os.path.join(get_data_folder(), "cache.sqlite"))
+    return _shared_cache
+
+
+def _reconnect_shared_cache():
+    """Runs in every forked child. Only the shared cache is reconnected, and only if it was opened."""
+
+    global _shared_cache_lock
+    # The lock may have been held by another thread of the parent at the time of the fork.
+    _shared_cache_lock = threading.Lock()
+    if _shared_cache is not None:
+        _shared_cache._reconnect_after_fork()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reconnect_shared_cache)
@@ -1,27 +1,31 @@
+import csv
 import pandas as pd
 from pandarallel import pandarallel
 import numpy as np
 from letterboxd_stats import cli
-from letterboxd_stats.web_scraper import get_tmdb_id
+from letterboxd_stats.web_scraper import get_tmdb_ids
 from letterboxd_stats import tmdb
 import os
-from letterboxd_stats import config
+from letterboxd_stats import config, get_data_folder
 from tqdm import tqdm
 
+# Columns of the exported files that are never shown, so they are not even parsed.
+SKIPPED_COLUMNS = {"Lists": ("Description",)}
+
 tqdm.pandas(desc="Fetching ids...")
 pandarallel.initialize(progress_bar=False, verbose=1)
 
 
-def check_if_watched(df: pd.DataFrame, row: pd.Series) -> bool:
+def check_if_watched(df: pd.DataFrame, row: pd.Series, tmdb_ids: dict[str, int | None]) -> bool:
     """watched.csv hasn't the TMDB id, so comparison can be done only by title.
     This creates the risk of mismatch when two films have the same title. To avoid this,
-    we must retrieve the TMDB id of the watched film.
+    we must retrieve the TMDB id of the watched film: tmdb_ids maps the links of watched films to their id.
     """
 
     if row["Title"] in df["Name"].values:
         watched_films_same_name = df[df["Name"] == row["Title"]]
         for _, film in watched_films_same_name.iterrows():
-            film_id = get_tmdb_id(film["Letterboxd URI"])
+            film_id = tmdb_ids.get(film["Letterboxd URI"])
             if film_id == row.name:
                 return True
     return False
@@ -31,11 +35,14 @@ def read_watched_films(df: pd.DataFrame, path: str, name: str) -> pd.DataFrame:
     """Check which film of a director you have seen. Add a column to show on the CLI."""
 
     df_profile = pd.read_csv(path)
+    # Resolve at once the ids of all the watched films that may match, so that the missing ones
+    # are scraped concurrently. Links that failed are in the result too (as None), so they aren't scraped again.
+    tmdb_ids = get_tmdb_ids(df_profile.loc[df_profile["Name"].isin(df["Title"]), "Letterboxd URI"].tolist())
     df.insert(
         0,
         "watched",
         np.where(
-            [check_if_watched(df_profile, row) for _, row in df.iterrows()],
+            [check_if_watched(df_profile, row, tmdb_ids) for _, row in df.iterrows()],
             "[X]",
             "[ ]",
         ),
@@ -55,8 +62,14 @@ def select_film_of_person(df: pd.DataFrame) -> pd.Series | None:
 
 
 def get_list_name(path: str) -> str:
-    df = pd.read_csv(path, header=1)
-    return df["Name"].iloc[0]
+    """The name is in the second row of the list export, right after the header of the list metadata.
+    Read just those lines, instead of parsing the entries of every list with pandas."""
+
+    with open(path, newline="", encoding="utf-8") as f:
+        rows = filter(None, csv.reader(f))
+        next(rows)
+        header, metadata = next(rows), next(rows)
+    return metadata[header.index("Name")]
 
 
 def open_list(path: str, limit: int, ascending: bool) -> str:
@@ -76,7 +89,8 @@ def open_file(filetype: str, path: str, limit, ascending, header=0) -> str:
     ordering and column filtering operations.
     """
 
-    df = pd.read_csv(path, header=header)
+    skipped_columns = SKIPPED_COLUMNS.get(filetype, ())
+    df = pd.read_csv(path, header=header, usecols=lambda column: column not in skipped_columns)
     df.rename(columns={"Name": "Title", "Letterboxd URI": "Url"}, inplace=True)
     df["Year"] = df["Year"].fillna(0).astype(int)
     df = FILE_OPERATIONS[filetype](df, ascending)
@@ -87,18 +101,17 @@ def open_file(filetype: str, path: str, limit, ascending, header=0) -> str:
 
 
 def _show_lists(df: pd.DataFrame, ascending: bool) -> pd.DataFrame:
-    ratings_path = os.path.expanduser(os.path.join(config["root_folder"], "static", "ratings.csv"))
+    ratings_path = os.path.join(get_data_folder(), "ratings.csv")
     df_ratings = pd.read_csv(ratings_path)
     df_ratings.rename(columns={"Letterboxd URI": "URL"}, inplace=True)
     df = df.merge(df_ratings[["URL", "Rating"]], on="URL", how="inner")
     df.rename(columns={"URL": "Url"}, inplace=True)
-    df = df.drop("Description", axis=1)
     df["Rating"] = df["Rating"].astype(float)
     sort_column = cli.select_value(df.columns.values.tolist(), "Select the order of your diary entries:")
     df.sort_values(by=sort_column, ascending=ascending, inplace=True)
     avg = {"Rating Mean": "{:.2f}".format(df["Rating"].mean())}
     if config["TMDB"]["get_list_runtimes"] is True:
-        ids = df["Url"].parallel_map(get_tmdb_id)
+        ids = df["Url"].map(get_tmdb_ids(df["Url"].tolist()))
         df["Duration"] = ids.parallel_map(lambda id: tmdb.get_movie_duration(id))  # type: ignore
         avg["Time-weighted Rating Mean"] = "{:.2f}".format(
             ((df["Duration"] / df["Duration"].sum()) * df["Rating"]).sum()
@@ -1,14 +1,25 @@
 import os
 import sys
+from functools import cache
 
-from letterboxd_stats import tmdb
-from letterboxd_stats import data
-from letterboxd_stats import web_scraper as ws
-from letterboxd_stats import args, config
+# tmdb, data and web_scraper pull in pandas, pandarallel, requests and lxml: each command imports
+# only what it needs, so a run with no command (or a failing one) doesn't pay for the others.
+from letterboxd_stats import args, config, get_data_folder
 
 DATA_FILES = {"Watchlist": "watchlist.csv", "Diary": "diary.csv", "Ratings": "ratings.csv", "Lists": "lists"}
 
 
+@cache
+def get_connector():
+    """The logged-in Letterboxd session, shared by all the commands of the run (e.g. -d together with -S)."""
+
+    from letterboxd_stats import web_scraper as ws
+
+    connector = ws.Connector()
+    connector.login()
+    return connector
+
+
 def try_command(command, args):
     try:
         command(*args)
@@ -17,25 +28,30 @@ def try_command(command, args):
 
 
 def check_path(path: str):
-    if not os.path.exists(path):
+    # Unlike os.path.exists, os.stat lets other errors (e.g. a permission denied) through with their own message.
+    try:
+        os.stat(path)
+    except FileNotFoundError:
         raise FileNotFoundError(
             f"No Letterboxd data was found in {path}. Make sure the path is correct or run -d to download your data"
-        )
+        ) from None
 
 
 def download_data():
     """Download exported data you find in the import/export section of your Letterboxd profile"""
 
-    connector = ws.Connector()
-    connector.login()
-    connector.download_stats()
+    get_connector().download_stats()
 
 
 def search_person(args_search: str):
     """Search for a director, list his/her films and check if you have watched them."""
 
+    from letterboxd_stats import tmdb
+    from letterboxd_stats import data
+    from letterboxd_stats import web_scraper as ws
+
     df, name = tmdb.get_person(args_search)
-    path = os.path.expanduser(os.path.join(config["root_folder"], "static", "watched.csv"))
+    path = os.path.join(get_data_folder(), "watched.csv")
     check_path(path)
     df = data.read_watched_films(df, path, name)
     film = data.select_film_of_person(df)
@@ -43,25 +59,30 @@ def search_person(args_search: str):
     while film is not None:
         search_film_query = f"{film['Title']} {film['Release Date'].year}"  # type: ignore
         title_url = ws.get_lb_title(search_film_query)
-        tmdb.get_movie_detail(int(film.name), ws.create_lb_url(title_url, "film_page"))  # type: ignore
+        tmdb.get_movie_detail(int(film.name), ws.film_page_url(title_url))  # type: ignore
         film = data.select_film_of_person(df)
 
 
 def search_film(args_search_film: str):
+    from letterboxd_stats import tmdb
+    from letterboxd_stats import web_scraper as ws
+
     title_url = ws.get_lb_title(args_search_film, True)
-    film_url = ws.create_lb_url(title_url, "film_page")
+    film_url = ws.film_page_url(title_url)
     tmdb.get_movie_detail(ws.get_tmdb_id(film_url), film_url)  # type: ignore
     answer = ws.select_optional_operation()
     if answer != "Exit":
-        connector = ws.Connector()
-        connector.login()
-        connector.perform_operation(answer, title_url)
+        get_connector().perform_operation(answer, title_url)
 
 
 def display_data(args_limit: int, args_ascending: bool, data_type: str):
     """Load and show on the CLI different .csv files that you have downloaded with the -d flag."""
 
-    path = os.path.expanduser(os.path.join(config["root_folder"], "static", DATA_FILES[data_type]))
+    from letterboxd_stats import tmdb
+    from letterboxd_stats import data
+    from letterboxd_stats import web_scraper as ws
+
+    path = os.path.join(get_data_folder(), DATA_FILES[data_type])
     check_path(path)
     letterboxd_url = (
         data.open_file(data_type, path, args_limit, args_ascending)
@@ -70,30 +91,29 @@ def display_data(args_limit: int, args_ascending: bool, data_type: str):
     )
     # If you select a film, show its details.
     if letterboxd_url is not None:
-        id = ws.get_tmdb_id(letterboxd_url, data_type == "diary")
+        id = ws.get_tmdb_id(letterboxd_url, data_type == "Diary")
         if id is not None:
             tmdb.get_movie_detail(id, letterboxd_url)
 
 
 def main():
+    limit, ascending = args.limit, config["CLI"]["ascending"]
+    # Commands run in this order, each one only if its argument is set.
+    commands = (
+        (args.download, download_data, ()),
+        (args.search, search_person, (args.search,)),
+        (args.search_film, search_film, (args.search_film,)),
+        (args.watchlist, display_data, (limit, ascending, "Watchlist")),
+        (args.diary, display_data, (limit, ascending, "Diary")),
+        (args.ratings, display_data, (limit, ascending, "Ratings")),
+        (args.lists, display_data, (limit, ascending, "Lists")),
+    )
     try:
-        if args.download:
-            try_command(download_data, ())
-        if args.search:
-            try_command(search_person, (args.search,))
-        if args.search_film:
-            try_command(search_film, (args.search_film,))
-        if args.watchlist:
-            try_command(display_data, (args.limit, config["CLI"]["ascending"], "Watchlist"))
-        if args.diary:
-            try_command(display_data, (args.limit, config["CLI"]["ascending"], "Diary"))
-        if args.ratings:
-            try_command(display_data, (args.limit, config["CLI"]["ascending"], "Ratings"))
-        if args.lists:
-            try_command(display_data, (args.limit, config["CLI"]["ascending"], "Lists"))
-        
+        for selected, command, command_args in commands:
+            if selected:
+                try_command(command, command_args)
     except KeyboardInterrupt:
-        print('\nProgram interrupted. Exiting.')
+        print("\nProgram interrupted. Exiting.")
         sys.exit(0)
 
 
@@ -1,3 +1,4 @@
+import json
 from typing import Any, Tuple
 from tmdbv3api import TMDb, Person, Movie, Search
 from tmdbv3api.exceptions import TMDbException
@@ -6,6 +7,10 @@ from pandarallel import pandarallel
 from tmdbv3api.objs.account import AsObj
 from letterboxd_stats import cli
 from letterboxd_stats import config
+from letterboxd_stats.cache import get_cache
+
+# The only fields of the TMDB movie details that are used, stored in the cache as JSON.
+MOVIE_DETAILS_KEYS = ("title", "original_title", "runtime", "overview", "release_date", "poster_path")
 
 tmdb = TMDb()
 tmdb.api_key = config["TMDB"]["api_key"]
@@ -67,8 +72,21 @@ def get_movie(movie_query: str) -> Any | AsObj:
     return search_results[result_index]
 
 
+def get_movie_details(movie_id: int) -> dict:
+    """Get movie details from the TMDB api. They hardly ever change, so they are cached like the TMDB ids.
+    https://developer.themoviedb.org/reference/movie-details
+    """
+
+    movie_details = get_cache().get("tmdb_movie", str(movie_id))
+    if movie_details is None:
+        response = movie.details(movie_id)
+        movie_details = json.dumps({key: response.get(key) for key in MOVIE_DETAILS_KEYS})
+        get_cache().save("tmdb_movie", str(movie_id), movie_details)
+    return json.loads(movie_details)
+
+
 def get_movie_detail(movie_id: int, letterboxd_url=None):
-    movie_details = movie.details(movie_id)
+    movie_details = get_movie_details(movie_id)
     poster = movie_details.get("poster_path")
     if poster is not None:
         cli.download_poster(poster)
@@ -85,12 +103,10 @@ def get_movie_detail(movie_id: int, letterboxd_url=None):
 
 
 def get_movie_duration(tmdb_id: int) -> int:
-    """Get movie duration from the TMDB api.
-    https://developer.themoviedb.org/reference/movie-details
-    """
+    """Get movie duration from the TMDB api."""
 
     try:
-        runtime = movie.details(tmdb_id).runtime  # type: ignore
+        runtime = get_movie_details(tmdb_id)["runtime"]
     except TMDbException:
         runtime = 0
     return runtime
@@ -1,12 +1,19 @@
 import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from tempfile import SpooledTemporaryFile
 from zipfile import ZipFile
-from letterboxd_stats import config
+from letterboxd_stats import config, get_data_folder
 from letterboxd_stats import cli
 import requests
-from lxml import html
-import shelve
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from lxml import etree, html
+from letterboxd_stats.cache import get_cache
 
 URL = "https://letterboxd.com"
+CSRF_COOKIE = "com.xk72.webparts.csrf"
 LOGIN_PAGE = URL + "/user/login.do"
 DATA_PAGE = URL + "/data/export"
 ADD_DIARY_URL = URL + "/s/save-diary-entry"
@@ -15,91 +22,229 @@ FILM_OPERATIONS = {
     "Add to watchlist": "add_watchlist_entry",
     "Remove from watchlist": "remove_watchlist_entry",
 }
-OPERATIONS_URLS = {
-    "search": lambda s: f"/s/search/{s}/",
-    "diary": lambda s: f"/csi/film/{s}/sidebar-user-actions/?esiAllowUser=true",
-    "add_watchlist": lambda s: f"/film/{s}/add-to-watchlist/",
-    "remove_watchlist": lambda s: f"/film/{s}/remove-from-watchlist/",
-    "film_page": lambda s: f"/film/{s}",
-}
+# Files of the exported data used by this tool. Folders end with "/".
+EXPORT_FILES = ("diary.csv", "lists/", "ratings.csv", "watched.csv", "watchlist.csv")
+# Ratings are expressed in half stars: 0 (no rating) to 10 (five stars).
+VALID_RATINGS = frozenset(range(11))
+
+# Pages are parsed from the raw bytes (no decoding to str first), dropping comments, processing instructions
+# and blank text. No id index is built: the parsed pages are only searched with XPath, which doesn't use it.
+HTML_PARSER = html.HTMLParser(
+    encoding="utf-8", remove_blank_text=True, remove_comments=True, remove_pis=True, collect_ids=False
+)
+# XPath expressions are compiled once.
+XPATH_SEARCH_RESULTS = etree.XPath("//div[@class='film-detail-content']")
+XPATH_RESULT_TITLE = etree.XPath("./h2/span/a")
+XPATH_RESULT_DIRECTOR = etree.XPath("./p/a")
+XPATH_RESULT_YEAR = etree.XPath("./h2/span//small/a")
+XPATH_FILM_TITLE = etree.XPath("//span[@class='film-title-wrapper']/a")
+# e.g. https://www.themoviedb.org/movie/346/
+TMDB_LINK_REGEX = re.compile(r"themoviedb\.org/(\w+)/(\d+)")
+
+# All the requests go to the same host: keep enough connections alive to serve them.
+POOL_SIZE = 16
+# Requests sent concurrently, kept low to avoid being throttled by Letterboxd.
+MAX_WORKERS = 8
+ARCHIVE_MAX_MEMORY = 32 << 20
+# Seconds to wait for Letterboxd to answer (for downloads: between two chunks), so that a stalled
+# connection can't hang a command or a worker of a thread pool.
+TIMEOUT = 10
+
+
+class _Retry(Retry):
+    """Letterboxd throttles requests with a 429 before handling them, so in that case it is safe to retry
+    any request, POSTs included. Other errors are retried only for idempotent requests."""
+
+    def is_retry(self, method, status_code, has_retry_after=False):
+        return status_code == 429 or super().is_retry(method, status_code, has_retry_after)
+
+
+def _create_session() -> requests.Session:
+    session = requests.Session()
+    # Waits follow the Retry-After header when Letterboxd sends it.
+    retries = _Retry(
+        total=5,
+        backoff_factor=0.5,
+        status_forcelist=(429, 500, 502, 503, 504),
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    session.mount("https://", HTTPAdapter(pool_maxsize=POOL_SIZE, max_retries=retries))
+    return session
+
+
+def _reset_session():
+    global session
+    session = _create_session()
+
 
-cache_path = os.path.expanduser(os.path.join(config["root_folder"], "static", "cache.db"))
+# Every request to Letterboxd goes through this session, so that connections and cookies are shared.
+session = _create_session()
+# Open connections can't be shared with forked processes (e.g. pandarallel workers).
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_session)
 
 
 class Connector:
-    def __init__(self):
-        self.session = requests.Session()
+    def __init__(self, username: str | None = None, password: str | None = None):
+        """Credentials default to the ones in the config file. A Connector given its own credentials also gets
+        its own session: cookies are per account, and sharing the jar would let the last login win for all."""
+
+        self.username = username or config["Letterboxd"]["username"]
+        self.password = password or config["Letterboxd"]["password"]
+        self.session = session if username is None and password is None else _create_session()
         # get home page to set cookies in the session.
-        self.session.get(URL)
+        self.session.get(URL, timeout=TIMEOUT)
+        self.csrf = self.session.cookies.get(CSRF_COOKIE)
+        self.operations = {operation: getattr(self, method) for operation, method in FILM_OPERATIONS.items()}
 
     def login(self):
         request_payload = {
-            "username": config["Letterboxd"]["username"],
-            "password": config["Letterboxd"]["password"],
-            "__csrf": self.session.cookies.get("com.xk72.webparts.csrf"),
+            "username": self.username,
+            "password": self.password,
+            "__csrf": self.csrf,
         }
-        res = self.session.post(LOGIN_PAGE, data=request_payload)
+        res = self.session.post(LOGIN_PAGE, data=request_payload, timeout=TIMEOUT)
         if res.json()["result"] != "success":
             raise ConnectionError("Failed to login")
+        # Logging in may issue a new token.
+        self.csrf = self.session.cookies.get(CSRF_COOKIE)
 
-    def download_stats(self):
+    def download_stats(self, files: tuple[str, ...] | None = EXPORT_FILES):
         """Download and extract data of the import/export section.
-        .CSV file will be extracted in the folder specified in the config file."""
+        .CSV file will be extracted in the folder specified in the config file.
+        Only the given files are extracted (folders end with "/"). Pass None to extract the whole archive."""
 
-        res = self.session.get(DATA_PAGE)
+        res = self.session.get(DATA_PAGE, stream=True, timeout=TIMEOUT)
         if res.status_code != 200 or "application/zip" not in res.headers["Content-Type"]:
             raise ConnectionError(f"Failed to download data. Response headers:\n{res.headers}")
         print("Data download successful.")
-        filename = res.headers["content-disposition"].split()[-1].split("=")[-1]
-        path = os.path.expanduser(os.path.join(config["root_folder"], "static"))
-        if not os.path.exists(path):
-            os.makedirs(path)
-        archive = os.path.join(path, filename)
-        with open(archive, "wb") as f:
-            f.write(res.content)
-        with ZipFile(archive, "r") as zip:
-            zip.extractall(path)
-        os.remove(archive)
-
-    def add_diary_entry(self, title: str):
-        payload = cli.get_input_add_diary_entry()
-        url = create_lb_url(title, "diary")
-        res = self.session.get(url)
-        if res.status_code != 200:
-            raise ConnectionError("Failed to retrieve the Letterboxd page")
-        film_page = html.fromstring(res.text)
-        # Not the TMDB id, but the Letterboxd ID to use to add the film to diary.
-        # Reference: https://letterboxd.com/film/seven-samurai/
-        letterboxd_film_id = film_page.get_element_by_id("frm-sidebar-rating").get("data-rateable-uid").split(":", 1)[1]
-        payload["filmId"] = letterboxd_film_id
-        payload["__csrf"] = self.session.cookies.get("com.xk72.webparts.csrf")
-        res = self.session.post(ADD_DIARY_URL, data=payload)
+        path = get_data_folder()
+        os.makedirs(path, exist_ok=True)
+        # The archive is kept in memory, and only spills to disk if it is bigger than ARCHIVE_MAX_MEMORY.
+        with SpooledTemporaryFile(max_size=ARCHIVE_MAX_MEMORY) as archive:
+            for chunk in res.iter_content(chunk_size=1 << 16):
+                archive.write(chunk)
+            with ZipFile(archive, "r") as zip:
+                _extract_archive(zip, path, files)
+
+    def get_lb_film_id(self, title: str) -> str:
+        """Not the TMDB id, but the Letterboxd ID to use to add the film to diary.
+        Reference: https://letterboxd.com/film/seven-samurai/
+        """
+
+        letterboxd_film_id = get_cache().get("lb_film_id", title)
+        if letterboxd_film_id is None:
+            url = f"{URL}/csi/film/{title}/sidebar-user-actions/?esiAllowUser=true"
+            res = self.session.get(url, timeout=TIMEOUT)
+            if res.status_code != 200:
+                raise ConnectionError("Failed to retrieve the Letterboxd page")
+            letterboxd_film_id = _find_lb_film_id(res.content)
+            if letterboxd_film_id is None:
+                raise ValueError(f"No Letterboxd id found for film: {title}")
+            get_cache().save("lb_film_id", title, letterboxd_film_id)
+        return letterboxd_film_id
+
+    def _post_operation(self, url: str, payload: dict, error_message: str):
+        """Letterboxd answers to a successful operation with {"result": true}."""
+
+        payload["__csrf"] = self.csrf
+        res = self.session.post(url, data=payload, timeout=TIMEOUT)
         if not (res.status_code == 200 and res.json()["result"] is True):
-            raise ConnectionError(f"Failed to add to diary.")
+            raise ConnectionError(error_message)
+
+    def add_diary_entry(self, title: str, payload: dict | None = None):
+        """Add a film to the diary. If no payload is given, ask the user for the details of the entry."""
+
+        if payload is None:
+            payload = cli.get_input_add_diary_entry()
+        elif payload.get("rating", 0) not in VALID_RATINGS:
+            raise ValueError(f"Invalid rating for {title}: {payload['rating']}")
+        payload = {**payload, "filmId": self.get_lb_film_id(title)}
+        self._post_operation(ADD_DIARY_URL, payload, "Failed to add to diary.")
         print(f"{title} was added to your diary.")
 
+    def add_diary_entries(self, entries: list[tuple[str, dict]]):
+        """Add many (title, payload) entries to the diary concurrently, e.g. when importing a diary.
+        Payloads have the same fields returned by cli.get_input_add_diary_entry."""
+
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            list(executor.map(lambda entry: self.add_diary_entry(*entry), entries))
+
     def add_watchlist_entry(self, title: str):
-        url = create_lb_url(title, "add_watchlist")
-        res = self.session.post(url, data={"__csrf": self.session.cookies.get("com.xk72.webparts.csrf")})
-        if not (res.status_code == 200 and res.json()["result"] is True):
-            raise ConnectionError("Failed to add to watchlist.")
+        self._post_operation(f"{URL}/film/{title}/add-to-watchlist/", {}, "Failed to add to watchlist.")
         print(f"{title} was added to your watchlist.")
 
     def remove_watchlist_entry(self, title: str):
-        url = create_lb_url(title, "remove_watchlist")
-        res = self.session.post(url, data={"__csrf": self.session.cookies.get("com.xk72.webparts.csrf")})
-        if not (res.status_code == 200 and res.json()["result"] is True):
-            raise ConnectionError("Failed to remove from watchlist.")
+        self._post_operation(f"{URL}/film/{title}/remove-from-watchlist/", {}, "Failed to remove from watchlist.")
         print(f"{title} was removed from your watchlist.")
 
     def perform_operation(self, operation: str, link: str):
         """Depending on what the user has chosen, add to diary, add/remove watchlist."""
 
-        getattr(self, FILM_OPERATIONS[operation])(link)
+        self.operations[operation](link)
+
+    def perform_operations(self, operations: list[tuple[str, str]]):
+        """Perform many (operation, link) pairs. The operations on the same link are performed in the given order,
+        and different links are handled concurrently over the pooled session. Adding to diary asks for user input,
+        so the links with a diary entry are handled one at a time, before the others."""
+
+        operations_by_link = {}
+        for operation, link in operations:
+            operations_by_link.setdefault(link, []).append(operation)
+        interactive_links, concurrent_links = [], []
+        for link, link_operations in operations_by_link.items():
+            is_interactive = any(self.operations[operation] == self.add_diary_entry for operation in link_operations)
+            (interactive_links if is_interactive else concurrent_links).append(link)
+
+        def perform_link_operations(link: str):
+            for operation in operations_by_link[link]:
+                self.perform_operation(operation, link)
+
+        for link in interactive_links:
+            perform_link_operations(link)
+        if len(concurrent_links) > 0:
+            with ThreadPoolExecutor(max_workers=min(MAX_WORKERS, len(concurrent_links))) as executor:
+                list(executor.map(perform_link_operations, concurrent_links))
+
+def _extract_archive(zip: ZipFile, path: str, files: tuple[str, ...] | None):
+    """Extract the members of the archive concurrently: reading from a ZipFile is thread-safe, and
+    decompression releases the GIL. Members are batched by their top-level folder (e.g. deleted/ also holds
+    deleted/lists/), so every folder is created by a single worker: makedirs in zipfile isn't safe to race."""
+
+    batches = {}
+    for member in zip.infolist():
+        if files is not None and not member.filename.startswith(files):
+            continue
+        batches.setdefault(member.filename.split("/", 1)[0], []).append(member)
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        list(executor.map(lambda batch: [zip.extract(member, path) for member in batch], batches.values()))
+
+
+def film_page_url(title: str) -> str:
+    return f"{URL}/film/{title}"
+
+
+def _find_tmdb_link(content: bytes) -> str | None:
+    """The TMDB link is all we need from a film page: stop parsing as soon as it is found."""
 
+    links = etree.iterparse(
+        BytesIO(content), events=("start",), tag="a", html=True, encoding="utf-8", remove_comments=True
+    )
+    for _, link in links:
+        if link.get("data-track-action") == "TMDb":
+            return link.get("href")
+    return None
 
-def create_lb_url(title: str, operation: str) -> str:
-    return URL + OPERATIONS_URLS[operation](title)
+
+def _find_lb_film_id(content: bytes) -> str | None:
+    """The rating form near the top of the sidebar holds the id: stop parsing as soon as it is found."""
+
+    elements = etree.iterparse(BytesIO(content), events=("start",), html=True, encoding="utf-8", remove_comments=True)
+    for _, element in elements:
+        if element.get("id") == "frm-sidebar-rating":
+            return element.get("data-rateable-uid").split(":", 1)[1]
+    return None
 
 
 def _get_tmdb_id_from_web(link: str, is_diary: bool) -> int:
@@ -107,27 +252,32 @@ def _get_tmdb_id_from_web(link: str, is_diary: bool) -> int:
     Inspect this HTML for reference: https://letterboxd.com/film/seven-samurai/
     """
 
-    res = requests.get(link)
-    film_page = html.fromstring(res.text)
+    content = session.get(link, timeout=TIMEOUT).content
     # Diary links sends you to a different page with no link to TMDB. Redirect to the actual page.
     if is_diary:
-        title_link = film_page.xpath("//span[@class='film-title-wrapper']/a")
+        film_page = html.fromstring(content, parser=HTML_PARSER)
+        title_link = XPATH_FILM_TITLE(film_page)
         if len(title_link) == 0:
             raise ValueError("No link found for film.")
         film_link = title_link[0]
         film_url = URL + film_link.get("href")
-        film_page = html.fromstring(requests.get(film_url).text)
-    tmdb_link = film_page.xpath("//a[@data-track-action='TMDb']")
-    if len(tmdb_link) == 0:
+        # Every diary entry has its own link, but rewatches of a film lead to the same film page.
+        prefix, key = film_url.rstrip("/").rsplit("/", 1)
+        tmdb_id = get_cache().get(prefix, key)
+        if tmdb_id is None:
+            tmdb_id = _get_tmdb_id_from_web(film_url, is_diary=False)
+            get_cache().save(prefix, key, tmdb_id)
+        return tmdb_id
+    tmdb_link = _find_tmdb_link(content)
+    if tmdb_link is None:
         raise ValueError("No link found for film")
-    
-    tmdb_category = tmdb_link[0].get("href").split("/")[-3]
-    
-    if tmdb_category != "movie":
-        full_link = tmdb_link[0].get("href")
-        raise ValueError(f"Tool does not currently support TMDB category \"{tmdb_category}\": {full_link}")
 
-    id = tmdb_link[0].get("href").split("/")[-2]
+    match = TMDB_LINK_REGEX.search(tmdb_link)
+    if match is None:
+        raise ValueError(f"Unexpected TMDB link: {tmdb_link}")
+    tmdb_category, id = match.groups()
+    if tmdb_category != "movie":
+        raise ValueError(f"Tool does not currently support TMDB category \"{tmdb_category}\": {tmdb_link}")
     return int(id)
 
 
@@ -139,21 +289,45 @@ def get_tmdb_id(link: str, is_diary=False) -> int | None:
     The cache is meant to avoid bottleneck of constantly retrieving the Id from an HTML page.
     """
 
-    tmdb_id_cache = shelve.open(cache_path, writeback=False, protocol=5)
-    prefix, key = link.rsplit("/", 1)
-    if prefix in tmdb_id_cache and key in tmdb_id_cache[prefix]:
-        id = tmdb_id_cache[prefix][key]
-    else:
-        try:
-            id = _get_tmdb_id_from_web(link, is_diary)
-            prefix_dict = tmdb_id_cache.get(prefix) or {}
-            prefix_dict[key] = id
-            tmdb_id_cache[prefix] = prefix_dict
-        except ValueError as e:
-            print(e)
-            id = None
-    tmdb_id_cache.close()
-    return id
+    return get_tmdb_ids([link], is_diary)[link]
+
+
+def _scrape_tmdb_id(link: str, is_diary: bool) -> int | None:
+    try:
+        return _get_tmdb_id_from_web(link, is_diary)
+    except ValueError as e:
+        print(e)
+        return None
+
+
+def get_tmdb_ids(links: list[str], is_diary=False) -> dict[str, int | None]:
+    """Bulk version of get_tmdb_id: the cache is read and written once per link prefix,
+    and the missing ids of all the prefixes are scraped concurrently."""
+
+    keys_by_prefix = {}
+    for link in links:
+        prefix, key = link.rsplit("/", 1)
+        keys_by_prefix.setdefault(prefix, {})[key] = None
+    cache = get_cache()
+    ids = {}
+    missing = []
+    for prefix, keys in keys_by_prefix.items():
+        cached_ids = cache.get_many(prefix, list(keys))
+        ids.update((f"{prefix}/{key}", id) for key, id in cached_ids.items())
+        missing.extend((prefix, key) for key in keys if key not in cached_ids)
+    if len(missing) == 0:
+        return ids
+    with ThreadPoolExecutor(max_workers=min(MAX_WORKERS, len(missing))) as executor:
+        scraped_ids = executor.map(lambda item: _scrape_tmdb_id(f"{item[0]}/{item[1]}", is_diary), missing)
+        scraped_ids = dict(zip(missing, scraped_ids))
+    found_by_prefix = {}
+    for (prefix, key), id in scraped_ids.items():
+        ids[f"{prefix}/{key}"] = id
+        if id is not None:
+            found_by_prefix.setdefault(prefix, []).append((key, id))
+    for prefix, found_ids in found_by_prefix.items():
+        cache.save_many(prefix, found_ids)
+    return ids
 
 
 def select_optional_operation() -> str:
@@ -165,26 +339,27 @@ def get_lb_title(title: str, allow_selection=False) -> str:
     For reference: https://letterboxd.com/search/seven+samurai/?adult
     """
 
-    search_url = create_lb_url(title, "search")
+    search_url = f"{URL}/s/search/{title}/"
     print(f"Searching for '{title}'")
-    res = requests.get(search_url)
+    res = session.get(search_url, timeout=TIMEOUT)
     if res.status_code != 200:
         raise ConnectionError("Failed to retrieve the Letterboxd page.")
-    search_page = html.fromstring(res.text)
+    search_page = html.fromstring(res.content, parser=HTML_PARSER)
     # If we want to select films from the search page, get more data to print the selection prompt.
     if allow_selection:
-        film_list = search_page.xpath("//div[@class='film-detail-content']")
+        film_list = XPATH_SEARCH_RESULTS(search_page)
         if len(film_list) == 0:
             raise ValueError(f"No results found for your Letterboxd film search.")
         title_years_directors_links = {}
         for film in film_list:
-            title = film.xpath("./h2/span/a")[0].text.rstrip()
-            director = director[0].text if len(director := film.xpath("./p/a")) > 0 else ""
-            year = f"({year[0].text}) " if len(year := film.xpath("./h2/span//small/a")) > 0 else ""
-            link = film.xpath("./h2/span/a")[0].get("href")
+            title_link = XPATH_RESULT_TITLE(film)[0]
+            title = title_link.text.rstrip()
+            director = director[0].text if len(director := XPATH_RESULT_DIRECTOR(film)) > 0 else ""
+            year = f"({year[0].text}) " if len(year := XPATH_RESULT_YEAR(film)) > 0 else ""
+            link = title_link.get("href")
             title_years_directors_links[f"{title} {year}- {director}"] = link
         selected_film = cli.select_value(list(title_years_directors_links.keys()), "Select your film")
         title_url = title_years_directors_links[selected_film].split("/")[-2]
     else:
-        title_url = search_page.xpath("//span[@class='film-title-wrapper']/a")[0].get("href").split("/")[-2]
+        title_url = XPATH_FILM_TITLE(search_page)[0].get("href").split("/")[-2]
     return title_url